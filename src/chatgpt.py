@@ -1,138 +1,450 @@
 import os
-import time
 import sys
-from openai import OpenAI
+import asyncio
+import argparse
+import hashlib
+import glob
+import json
+import logging
+import httpx
+from openai import (
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    APIError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+    before_sleep_log,
+)
 from dotenv import load_dotenv
-from prompts import PROMPT_GENERATE_MDT, PROMPT_FACTUAL_CORRECTNESS, PROMPT_PLAUSIBILITY
+from pypdf import PdfReader
+from prompts import (
+    SYSTEM_PREFIX,
+    PROMPT_GENERATE_MDT,
+    PROMPT_COMBINED_EVAL,
+    PROMPT_COMBINED_EVAL_BATCH,
+)
+from llm_cache import LLMCache, SemanticCache, make_key
+from evaluation import parse_evaluation, parse_batch_evaluation, micro_batches
+
+log = logging.getLogger("mdt")
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI Client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Upper bound in seconds for a single request
+REQUEST_TIMEOUT = 60
 
+# Transient failures worth retrying
+RETRYABLE_ERRORS = (APITimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+
+# Most requests run at once, e.g. transcripts for a directory of PDFs
+MAX_CONNECTIONS = 20
+
+# Initialize OpenAI Client, with a connection pool large enough for the
+# requests that run concurrently
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS, max_keepalive_connections=10
+        ),
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=5.0),
+    ),
+)
+
+MODEL = "gpt-4o"
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Persistent response cache shared across runs
+cache = LLMCache()
+
+# Batch jobs finish within 24 hours, so poll them slowly
+BATCH_POLL_INITIAL = 5
+BATCH_POLL_MAX = 600
+
+# Context window of MODEL in tokens, used to size evaluation micro-batches
+CONTEXT_TOKENS = 128_000
 
-def upload_file(file_path):
-    """Uploads a file to OpenAI for use with assistants."""
-    if not os.path.exists(file_path):
-        print(f"Error: File not found at {file_path}")
-        sys.exit(1)
 
-    print(f"Uploading file: {file_path}...")
-    file = client.files.create(file=open(file_path, "rb"), purpose="assistants")
-    print(f"File uploaded. ID: {file.id}")
-    return file
+def build_messages(case_study, prompt):
+    """Builds the chat messages for a task on the given case study.
 
+    The case study goes in the system message ahead of the task prompt, so every
+    task on the same case shares a prefix that OpenAI can serve from its cache.
+    """
+    return [
+        {"role": "system", "content": SYSTEM_PREFIX + case_study},
+        {"role": "user", "content": prompt},
+    ]
 
-def create_assistant():
-    """Creates an assistant with file search capabilities."""
-    print("Creating Assistant...")
-    assistant = client.beta.assistants.create(
-        name="MDT Generator & Evaluator",
-        instructions="You are a helpful medical AI assistant capable of analyzing case studies and generating transcripts.",
-        model="gpt-4o",
-        tools=[{"type": "file_search"}],
+
+async def get_model_response(
+    case_study, prompt, echo=False, json_output=False, validate=None
+):
+    """Gets a response from the model, returning a cached one if available.
+
+    With echo=True the response is written to stdout as it is generated.
+    validate is passed on to LLMCache.get_or_set.
+    """
+    case_hash = hashlib.sha256(case_study.encode("utf-8")).hexdigest()
+    streamed = False
+
+    async def fetch():
+        nonlocal streamed
+        streamed = True
+        return await _get_model_response(case_study, prompt, echo, json_output)
+
+    text = await cache.get_or_set(
+        make_key(MODEL, prompt, case_hash), fetch, validate
     )
-    print(f"Assistant created. ID: {assistant.id}")
-    return assistant
+    if echo and not streamed:
+        print(text)
+    return text
+
 
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(min=1, max=30),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    before_sleep=before_sleep_log(log, logging.WARNING),
+    reraise=True,
+)
+async def _get_model_response(case_study, prompt, echo=False, json_output=False):
+    """Gets a streamed chat completion from the model.
 
-def run_thread(assistant_id, thread_id):
-    """Runs the thread and waits for completion."""
-    run = client.beta.threads.runs.create(
-        thread_id=thread_id, assistant_id=assistant_id
+    Transient failures are retried with jittered backoff, for up to 3 attempts,
+    unless part of the response has already been echoed.
+    """
+    log.debug("Generating response from ChatGPT...")
+    options = {"response_format": {"type": "json_object"}} if json_output else {}
+    # tenacity owns the retries here, so disable the SDK's own to avoid multiplying them
+    stream = await client.with_options(
+        max_retries=0, timeout=REQUEST_TIMEOUT
+    ).chat.completions.create(
+        model=MODEL,
+        messages=build_messages(case_study, prompt),
+        stream=True,
+        stream_options={"include_usage": True},
+        **options,
     )
 
-    print(f"Run started (ID: {run.id}). Waiting for completion...")
-    while True:
-        run_status = client.beta.threads.runs.retrieve(
-            thread_id=thread_id, run_id=run.id
-        )
-        if run_status.status == "completed":
-            print("Run completed.")
-            break
-        elif run_status.status in ["failed", "cancelled", "expired"]:
-            print(f"Run failed with status: {run_status.status}")
-            sys.exit(1)
-        time.sleep(2)
-
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    # Return the latest message content
-    return messages.data[0].content[0].text.value
-
-
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python src/chatgpt.py <path_to_pdf>")
-        sys.exit(1)
+    chunks = []
+    usage = None
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                text = chunk.choices[0].delta.content
+                chunks.append(text)
+                if echo:
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+    except RETRYABLE_ERRORS as e:
+        # A retry would echo the response again from the start
+        if echo and chunks:
+            raise RuntimeError("Response stream was interrupted.") from e
+        raise
 
-    pdf_path = sys.argv[1]
+    if echo:
+        print()
+    log.debug("Response received.")
 
-    # 1. Upload File
-    file_obj = upload_file(pdf_path)
+    # Report how much of the prompt was served from OpenAI's prefix cache
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None:
+        log.debug("Cached prompt tokens: %s", details.cached_tokens)
 
-    # 2. Create Assistant
-    assistant = create_assistant()
+    return "".join(chunks)
 
-    # 3. Create Thread
-    print("Creating Thread...")
-    thread = client.beta.threads.create()
 
-    try:
-        # --- TASK 1: Generate MDT Transcript ---
-        print("\n--- Task 1: Generating MDT Transcript ---")
+def extract_pdf_text(file_path):
+    """Extracts the text of a PDF so it can be sent inline."""
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found at {file_path}")
+    return "\n".join(page.extract_text() or "" for page in PdfReader(file_path).pages)
+
+
+async def embed(text):
+    """Embeds text for the semantic cache."""
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
 
-        client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=PROMPT_GENERATE_MDT,
-            attachments=[{"file_id": file_obj.id, "tools": [{"type": "file_search"}]}],
-        )
 
-        transcript = run_thread(assistant.id, thread.id)
+async def run(pdf_path, echo=True, semantic_cache=False):
+    """Generates and evaluates an MDT transcript for the case study at pdf_path.
+
+    With echo=True the transcript is streamed and each result printed as it
+    becomes available. With semantic_cache=True the evaluation is reused for
+    transcripts similar to a previously evaluated one. Returns the transcript
+    and both evaluations.
+    """
+    # 1. Extract the case study text
+    case_study = extract_pdf_text(pdf_path)
+
+    # --- TASK 1: Generate MDT Transcript ---
+    if echo:
+        print("\n--- Task 1: Generating MDT Transcript ---")
         print("\n[GENERATED TRANSCRIPT]\n")
-        print(transcript)
+    transcript = await get_model_response(case_study, PROMPT_GENERATE_MDT, echo=echo)
+    if echo:
         print("\n" + "=" * 50 + "\n")
 
-        # --- TASK 2: Factual Correctness ---
-        print("\n--- Task 2: Evaluating Factual Correctness ---")
+    # --- TASKS 2 & 3: Factual Correctness and Plausibility ---
+    # Both evaluations are requested in a single call so the transcript is sent once.
+    if echo:
+        print("\n--- Tasks 2 & 3: Evaluating Factual Correctness and Plausibility ---")
 
-        formatted_prompt_factual = PROMPT_FACTUAL_CORRECTNESS.format(
-            transcript=transcript
+    formatted_prompt_eval = PROMPT_COMBINED_EVAL.format(transcript=transcript)
+
+    async def evaluate():
+        return await get_model_response(
+            case_study, formatted_prompt_eval, json_output=True, validate=parse_evaluation
         )
 
-        client.beta.threads.messages.create(
-            thread_id=thread.id, role="user", content=formatted_prompt_factual
+    if semantic_cache:
+        raw_evaluation = await SemanticCache(embed).get_or_set(
+            f"{MODEL}:{EMBEDDING_MODEL}:combined_eval",
+            transcript,
+            evaluate,
+            validate=parse_evaluation,
         )
+    else:
+        raw_evaluation = await evaluate()
+    evaluation = parse_evaluation(raw_evaluation)
 
-        factual_feedback = run_thread(assistant.id, thread.id)
+    if echo:
         print("\n[FACTUAL CORRECTNESS FEEDBACK]\n")
-        print(factual_feedback)
+        print(evaluation["factual"])
         print("\n" + "=" * 50 + "\n")
 
-        # --- TASK 3: Plausibility ---
-        print("\n--- Task 3: Evaluating Plausibility ---")
+        print("\n[PLAUSIBILITY FEEDBACK]\n")
+        print(evaluation["plausibility"])
+        print("\n" + "=" * 50 + "\n")
 
-        formatted_prompt_plausibility = PROMPT_PLAUSIBILITY.format(
-            transcript=transcript
-        )
+    return {
+        "transcript": transcript,
+        "factual": evaluation["factual"],
+        "plausibility": evaluation["plausibility"],
+    }
+
+
+async def batch_main(pdf_dir):
+    """Generates and evaluates MDT transcripts for every PDF in pdf_dir.
+
+    Transcripts are generated concurrently; files whose transcript fails are
+    logged and skipped. The evaluations are grouped into
+    micro-batches of several cases per request and submitted together through
+    the Batch API, which is billed at half price but may take up to 24 hours.
+    Returns the results keyed by file name.
+    """
+    pdf_paths = sorted(glob.glob(os.path.join(pdf_dir, "*.pdf")))
+    if not pdf_paths:
+        raise FileNotFoundError(f"No PDF files found in {pdf_dir}")
+
+    case_studies = [extract_pdf_text(p) for p in pdf_paths]
 
-        client.beta.threads.messages.create(
-            thread_id=thread.id, role="user", content=formatted_prompt_plausibility
+    # --- TASK 1: Generate MDT Transcripts ---
+    print(f"\n--- Task 1: Generating MDT Transcripts for {len(pdf_paths)} files ---")
+    # Bounded so a large directory stays within the connection pool and rate limits
+    semaphore = asyncio.Semaphore(MAX_CONNECTIONS)
+
+    async def generate(case_study):
+        async with semaphore:
+            return await get_model_response(case_study, PROMPT_GENERATE_MDT)
+
+    outcomes = await asyncio.gather(
+        *(generate(c) for c in case_studies), return_exceptions=True
+    )
+    # One failed file must not discard the others' transcripts
+    generated = []
+    for pdf_path, case_study, outcome in zip(pdf_paths, case_studies, outcomes):
+        if isinstance(outcome, BaseException):
+            log.warning(
+                "Transcript generation failed for %s: %s",
+                os.path.basename(pdf_path),
+                outcome,
+            )
+        else:
+            generated.append((pdf_path, case_study, outcome))
+    if not generated:
+        raise RuntimeError("No transcripts were generated.")
+    pdf_paths, case_studies, transcripts = (list(column) for column in zip(*generated))
+
+    # --- TASKS 2 & 3: Factual Correctness and Plausibility ---
+    print("\n--- Tasks 2 & 3: Submitting evaluations to the Batch API ---")
+    # Roughly 4 characters per token
+    batches = micro_batches(
+        [(len(c) + len(t)) // 4 for c, t in zip(case_studies, transcripts)],
+        CONTEXT_TOKENS,
+    )
+    requests = []
+    for n, indices in enumerate(batches):
+        cases = "\n".join(
+            f"CASE STUDY[{j}]:\n{case_studies[i]}\n\nTRANSCRIPT[{j}]:\n{transcripts[i]}\n"
+            for j, i in enumerate(indices)
         )
+        requests.append(
+            {
+                "custom_id": f"batch-{n}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL,
+                    "response_format": {"type": "json_object"},
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": PROMPT_COMBINED_EVAL_BATCH.format(cases=cases),
+                        }
+                    ],
+                },
+            }
+        )
+    batch_input = "\n".join(json.dumps(r) for r in requests).encode("utf-8")
+
+    input_file = await client.files.create(
+        file=("requests.jsonl", batch_input, "application/jsonl"), purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    log.info(
+        "Batch submitted (ID: %s, %d files in %d requests). Waiting for completion...",
+        batch.id,
+        len(pdf_paths),
+        len(requests),
+    )
+
+    delay = BATCH_POLL_INITIAL
+    last_status = batch.status
+    while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX)
+        batch = await client.batches.retrieve(batch.id)
+        # Only log when the status changes, not on every poll
+        if batch.status != last_status:
+            log.debug("Batch status: %s", batch.status)
+            last_status = batch.status
+    # A failed or expired batch may still have finished some requests, so the
+    # transcripts are reported either way
+    if batch.status == "completed":
+        log.info("Batch completed (ID: %s).", batch.id)
+    else:
+        log.error("Batch %s ended with status: %s", batch.id, batch.status)
+
+    def file_names(record):
+        indices = batches[int(record["custom_id"].split("-")[1])]
+        return indices, ", ".join(os.path.basename(pdf_paths[i]) for i in indices)
+
+    evaluations = {}
+    # Both files are unset when no request finished or failed, respectively
+    if batch.output_file_id is not None:
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            record = json.loads(line)
+            indices, names = file_names(record)
+            response = record.get("response")
+            if record.get("error") or not response or response["status_code"] != 200:
+                log.warning("Evaluation failed for %s: %s", names, record.get("error"))
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            try:
+                entries = parse_batch_evaluation(content)
+            except ValueError as e:
+                log.warning("Could not parse evaluation for %s: %s", names, e)
+                continue
+            # Map each entry's index within the micro-batch back to its file
+            for j, entry in entries.items():
+                if 0 <= j < len(indices):
+                    evaluations[os.path.basename(pdf_paths[indices[j]])] = entry
+
+    if batch.error_file_id is not None:
+        errors = await client.files.content(batch.error_file_id)
+        for line in errors.text.splitlines():
+            record = json.loads(line)
+            _, names = file_names(record)
+            error = record.get("error") or (record.get("response") or {}).get("body")
+            log.warning("Evaluation failed for %s: %s", names, error)
+
+    missing = [
+        os.path.basename(p) for p in pdf_paths if os.path.basename(p) not in evaluations
+    ]
+    if missing:
+        log.warning("No evaluation for: %s", ", ".join(missing))
+
+    results = {}
+    for pdf_path, transcript in zip(pdf_paths, transcripts):
+        name = os.path.basename(pdf_path)
+        evaluation = evaluations.get(name, {})
+        results[name] = {
+            "transcript": transcript,
+            "factual": evaluation.get("factual"),
+            "plausibility": evaluation.get("plausibility"),
+        }
+
+        print("\n" + "#" * 50)
+        print(f"# {name}")
+        print("#" * 50)
+
+        print("\n[GENERATED TRANSCRIPT]\n")
+        print(transcript)
+        print("\n" + "=" * 50 + "\n")
+
+        print("\n[FACTUAL CORRECTNESS FEEDBACK]\n")
+        print(results[name]["factual"])
+        print("\n" + "=" * 50 + "\n")
 
-        plausibility_feedback = run_thread(assistant.id, thread.id)
         print("\n[PLAUSIBILITY FEEDBACK]\n")
-        print(plausibility_feedback)
+        print(results[name]["plausibility"])
         print("\n" + "=" * 50 + "\n")
 
-    finally:
-        # Clean up the created file and assistant
-        print("Cleaning up resources...")
-        client.files.delete(file_obj.id)
-        client.beta.assistants.delete(assistant.id)
-        print("Cleanup complete.")
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Generate and evaluate an MDT transcript with ChatGPT."
+    )
+    parser.add_argument(
+        "pdf_path",
+        help="path to the case study PDF, or a directory of PDFs to evaluate in a batch",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="reuse evaluations of similar transcripts",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="log per-request progress (same as MDT_LOG=DEBUG)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        level="DEBUG" if args.verbose else os.getenv("MDT_LOG", "INFO"),
+        format="%(message)s",
+    )
+
+    try:
+        if os.path.isdir(args.pdf_path):
+            await batch_main(args.pdf_path)
+        else:
+            await run(args.pdf_path, semantic_cache=args.semantic_cache)
+    except (APIError, OSError, RuntimeError, ValueError) as e:
+        log.error("Error: %s", e)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import re
+import json
+
+# Fields every combined evaluation must contain
+EVALUATION_FIELDS = ("factual", "plausibility")
+
+# Cases evaluated per request when processing a directory, and the share of the
+# model's context window a single request may fill
+MICRO_BATCH_SIZE = 8
+MICRO_BATCH_CONTEXT_SHARE = 0.6
+
+# A Markdown code fence around a reply, with or without a language tag
+_CODE_FENCE = re.compile(r"^```[\w-]*\s*(.*?)\s*```$", re.DOTALL)
+
+
+def parse_json(text):
+    """Parses a JSON reply, tolerating a surrounding code fence."""
+    text = text.strip()
+    fenced = _CODE_FENCE.match(text)
+    if fenced:
+        text = fenced.group(1)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Could not parse evaluation as JSON:\n{text}") from e
+
+
+def parse_evaluation(text):
+    """Parses a combined evaluation reply.
+
+    Raises ValueError if the reply is not JSON or lacks one of EVALUATION_FIELDS.
+    """
+    evaluation = parse_json(text)
+    if not isinstance(evaluation, dict) or any(
+        field not in evaluation for field in EVALUATION_FIELDS
+    ):
+        raise ValueError(f"Evaluation is missing {' or '.join(EVALUATION_FIELDS)}:\n{text}")
+    return evaluation
+
+
+def parse_batch_evaluation(text):
+    """Parses a micro-batch evaluation reply into its entries keyed by case index.
+
+    Entries without an integer index or one of EVALUATION_FIELDS are skipped.
+    Raises ValueError if the reply is not JSON or has no evaluations list.
+    """
+    reply = parse_json(text)
+    entries = reply.get("evaluations") if isinstance(reply, dict) else None
+    if not isinstance(entries, list):
+        raise ValueError(f"Evaluation has no evaluations list:\n{text}")
+
+    evaluations = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get("index")
+        if isinstance(index, bool) or not isinstance(index, int):
+            continue
+        if all(field in entry for field in EVALUATION_FIELDS):
+            evaluations[index] = entry
+    return evaluations
+
+
+def micro_batches(sizes, context_tokens):
+    """Groups case indices so each group fits in a single evaluation request.
+
+    sizes holds the estimated token count of each case. A group holds at most
+    MICRO_BATCH_SIZE cases and MICRO_BATCH_CONTEXT_SHARE of context_tokens; a
+    case larger than that on its own gets a group to itself.
+    """
+    max_tokens = int(context_tokens * MICRO_BATCH_CONTEXT_SHARE)
+    batches, current, tokens = [], [], 0
+    for i, size in enumerate(sizes):
+        if current and (len(current) == MICRO_BATCH_SIZE or tokens + size > max_tokens):
+            batches.append(current)
+            current, tokens = [], 0
+        current.append(i)
+        tokens += size
+    if current:
+        batches.append(current)
+    return batches
@@ -0,0 +1,68 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from llm_cache import CACHE_DIR
+
+log = logging.getLogger("mdt")
+
+# Maps file content hashes to the IDs of their uploaded copies on each provider
+REGISTRY_PATH = os.path.join(CACHE_DIR, "files.json")
+
+# For each provider: the attribute holding the file's ID and how long uploads are kept
+PROVIDERS = {
+    "gemini": ("name", 48 * 60 * 60),
+}
+
+
+def file_sha256(path):
+    """Hashes a file in 1 MiB chunks so it is never fully read into memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_registry():
+    try:
+        with open(REGISTRY_PATH) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _save_entry(digest, provider, file_id, expiry):
+    # Re-read before writing so concurrent backends don't drop each other's entries
+    registry = _load_registry()
+    registry.setdefault(digest, {})[provider] = {"id": file_id, "expiry": expiry}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(REGISTRY_PATH, "w") as f:
+        json.dump(registry, f, indent=2)
+
+
+async def get_or_upload(path, provider, uploader_fn, resolver_fn):
+    """Returns the provider's copy of the file at path, uploading it only if needed.
+
+    uploader_fn() uploads the file and returns the provider's file object.
+    resolver_fn(file_id) returns the existing file object, or None if it no
+    longer exists. The returned object carries the content hash as `sha256`.
+    """
+    id_attr, lifetime = PROVIDERS[provider]
+    digest = file_sha256(path)
+
+    file_obj = None
+    entry = _load_registry().get(digest, {}).get(provider)
+    if entry and entry["expiry"] > time.time():
+        file_obj = await resolver_fn(entry["id"])
+        if file_obj is not None:
+            log.info("Reusing uploaded file: %s", entry["id"])
+
+    if file_obj is None:
+        file_obj = await uploader_fn()
+        _save_entry(digest, provider, getattr(file_obj, id_attr), time.time() + lifetime)
+
+    # Content hash used to key cached responses for this file
+    file_obj.sha256 = digest
+    return file_obj
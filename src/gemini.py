@@ -1,11 +1,33 @@
 import os
 import sys
-import time
+import asyncio
+import argparse
+import functools
+import glob
+import logging
 import magic
 import mimetypes
 from dotenv import load_dotenv
 import google.generativeai as genai
-from prompts import PROMPT_GENERATE_MDT, PROMPT_FACTUAL_CORRECTNESS, PROMPT_PLAUSIBILITY
+from pypdf import PdfReader
+from google.api_core import exceptions as google_exceptions
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+    before_sleep_log,
+)
+from prompts import (
+    PROMPT_GENERATE_MDT,
+    PROMPT_COMBINED_EVAL,
+    PROMPT_COMBINED_EVAL_BATCH,
+)
+from llm_cache import LLMCache, SemanticCache, make_key
+from file_registry import get_or_upload
+from evaluation import parse_evaluation, parse_batch_evaluation, micro_batches
+
+log = logging.getLogger("mdt")
 
 # Load environment variables
 load_dotenv()
@@ -13,8 +35,39 @@ load_dotenv()
 # Configure Gemini API
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Upper bound in seconds to wait for a response to start, and for each streamed chunk
+REQUEST_TIMEOUT = 60
+
+# Transient failures worth retrying
+RETRYABLE_ERRORS = (
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.ResourceExhausted,
+    asyncio.TimeoutError,
+)
+
+# Most files uploaded and transcribed at once when processing a directory
+MAX_CONCURRENT_REQUESTS = 20
+
+# Context window in tokens of the models pick_available_model() chooses from,
+# used to size evaluation micro-batches
+CONTEXT_TOKENS = 1_000_000
+
+# Tokens Gemini bills for each page of an attached PDF
+TOKENS_PER_PDF_PAGE = 258
+
+# Persistent response cache shared across runs
+cache = LLMCache()
+
+# A single libmagic cookie, so the magic database is only loaded once
+_MAGIC = magic.Magic(mime=True)
 
-# Choose an available model (prefer 2.0 flash, then 1.5 variants)
+
+# Choose an available model (prefer 2.0 flash, then 1.5 variants).
+# Memoized so the model list is only fetched once per process.
+@functools.lru_cache(maxsize=1)
 def pick_available_model():
     try:
         available = list(genai.list_models())
@@ -36,103 +89,399 @@ def pick_available_model():
         for suf in priority_suffixes:
             for m in candidates:
                 if m.name.endswith(suf):
-                    print(f"Using Gemini model: {m.name}")
+                    log.info("Using Gemini model: %s", m.name)
                     return m.name
         # Fallback to the first candidate
         if candidates:
-            print(f"Using fallback Gemini model: {candidates[0].name}")
+            log.info("Using fallback Gemini model: %s", candidates[0].name)
             return candidates[0].name
     except Exception as e:
-        print(
-            f"Warning: could not list models, defaulting to gemini-1.5-flash-8b. Error: {e}"
+        log.warning(
+            "Could not list models, defaulting to gemini-1.5-flash-8b. Error: %s", e
         )
     return "gemini-1.5-flash-8b"
 
 
-def upload_file(file_path):
-    """Uploads a file to Google for use with Gemini."""
-    if not os.path.exists(file_path):
-        print(f"Error: File not found at {file_path}")
-        sys.exit(1)
+@functools.lru_cache(maxsize=None)
+def get_model(model_name):
+    """Returns a shared GenerativeModel instance for the given model name."""
+    return genai.GenerativeModel(model_name=model_name)
+
 
-    print(f"Uploading file: {file_path}...")
-    # Use python-magic to determine the mime type
-    mime_type = magic.from_file(file_path, mime=True)
+async def upload_file(file_path):
+    """Uploads a file to Google for use with Gemini.
 
-    # Fallback if mime type is not detected
-    if not mime_type:
+    A previous upload of the same content is reused if it has not expired.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found at {file_path}")
+
+    async def upload():
+        log.info("Uploading file: %s...", file_path)
+        # Guess the mime type from the extension first; it needs no file I/O
         mime_type, _ = mimetypes.guess_type(file_path)
 
-    if not mime_type:
-        print(
-            f"Could not determine mime type for {file_path}. Defaulting to application/octet-stream."
+        # Fallback to python-magic if the extension is not recognised
+        if not mime_type:
+            try:
+                mime_type = _MAGIC.from_file(file_path)
+            except magic.MagicException:
+                mime_type = None
+
+        if not mime_type:
+            log.warning(
+                "Could not determine mime type for %s. Defaulting to application/octet-stream.",
+                file_path,
+            )
+            mime_type = "application/octet-stream"
+
+        uploaded_file = await asyncio.to_thread(
+            genai.upload_file, path=file_path, mime_type=mime_type
         )
-        mime_type = "application/octet-stream"
+        log.info("File uploaded. Name: %s", uploaded_file.name)
+        return uploaded_file
 
-    uploaded_file = genai.upload_file(path=file_path, mime_type=mime_type)
-    print(f"File uploaded. Name: {uploaded_file.name}")
-    return uploaded_file
+    async def resolve(name):
+        try:
+            return await asyncio.to_thread(genai.get_file, name)
+        except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+            # Expired or deleted files are reported as either of these
+            return None
 
+    return await get_or_upload(file_path, "gemini", upload, resolve)
 
-def get_model_response(prompt, file_obj, model_name=None):
-    """Gets a response from the Gemini model."""
-    print("Generating response from Gemini...")
+
+async def get_model_response(
+    prompt,
+    file_obj=None,
+    model_name=None,
+    generation_config=None,
+    echo=False,
+    validate=None,
+):
+    """Gets a response from the Gemini model, returning a cached one if available.
+
+    file_obj may also be a list of files, which are attached in order. With
+    echo=True the response is written to stdout as it is generated. validate is
+    passed on to LLMCache.get_or_set.
+    """
     model_name = model_name or pick_available_model()
-    model = genai.GenerativeModel(model_name=model_name)
-    response = model.generate_content([prompt, file_obj])
-    print("Response received.")
-    return response.text
+    file_objs = file_obj if isinstance(file_obj, list) else [file_obj]
+    file_hash = "".join(f.sha256 for f in file_objs if f is not None)
+    streamed = False
 
+    async def fetch():
+        nonlocal streamed
+        streamed = True
+        return await _get_model_response(
+            prompt, file_obj, model_name, generation_config, echo
+        )
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python src/gemini.py <path_to_pdf>")
-        sys.exit(1)
+    text = await cache.get_or_set(
+        make_key(model_name, prompt, file_hash), fetch, validate
+    )
+    if echo and not streamed:
+        print(text)
+    return text
 
-    pdf_path = sys.argv[1]
 
-    # 1. Upload File
-    file_obj = upload_file(pdf_path)
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(min=1, max=30),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    before_sleep=before_sleep_log(log, logging.WARNING),
+    reraise=True,
+)
+async def _get_model_response(
+    prompt, file_obj, model_name, generation_config=None, echo=False
+):
+    """Gets a streamed response from the Gemini model.
 
+    Transient failures are retried with jittered backoff, for up to 3 attempts,
+    unless part of the response has already been echoed.
+    """
+    log.debug("Generating response from Gemini...")
+    model = get_model(model_name)
+    if file_obj is None:
+        contents = prompt
+    elif isinstance(file_obj, list):
+        contents = [prompt, *file_obj]
+    else:
+        contents = [prompt, file_obj]
+    response = await asyncio.wait_for(
+        model.generate_content_async(
+            contents, generation_config=generation_config, stream=True
+        ),
+        REQUEST_TIMEOUT,
+    )
+    chunks = []
+    # The timeout applies per chunk, so long responses are not cut off while streaming
+    stream = aiter(response)
     try:
-        # --- TASK 1: Generate MDT Transcript ---
+        while (
+            chunk := await asyncio.wait_for(anext(stream, None), REQUEST_TIMEOUT)
+        ) is not None:
+            # Chunks carrying only a finish reason or safety ratings have no text
+            if not chunk.parts:
+                continue
+            chunks.append(chunk.text)
+            if echo:
+                sys.stdout.write(chunk.text)
+                sys.stdout.flush()
+    except RETRYABLE_ERRORS as e:
+        # A retry would echo the response again from the start
+        if echo and chunks:
+            raise RuntimeError("Response stream was interrupted.") from e
+        raise
+    if not chunks:
+        # The streamed response aggregates its chunks, so it holds the finish reason
+        reason = (
+            response.candidates[0].finish_reason
+            if response.candidates
+            else response.prompt_feedback
+        )
+        raise ValueError(f"Gemini returned no text: {reason}")
+    if echo:
+        print()
+    log.debug("Response received.")
+    return "".join(chunks)
+
+
+async def embed(text):
+    """Embeds text for the semantic cache."""
+    response = await genai.embed_content_async(model=EMBEDDING_MODEL, content=text)
+    return response["embedding"]
+
+
+async def run(pdf_path, echo=True, semantic_cache=False):
+    """Generates and evaluates an MDT transcript for the case study at pdf_path.
+
+    With echo=True the transcript is streamed and each result printed as it
+    becomes available. With semantic_cache=True the evaluation is reused for
+    transcripts similar to a previously evaluated one. Returns the transcript
+    and both evaluations.
+    """
+    # 1. Upload File and 2. Resolve the model once for all tasks, which are independent
+    file_obj, model_name = await asyncio.gather(
+        upload_file(pdf_path), asyncio.to_thread(pick_available_model)
+    )
+
+    # --- TASK 1: Generate MDT Transcript ---
+    if echo:
         print("\n--- Task 1: Generating MDT Transcript ---")
-        transcript = get_model_response(PROMPT_GENERATE_MDT, file_obj)
         print("\n[GENERATED TRANSCRIPT]\n")
-        print(transcript)
+    transcript = await get_model_response(
+        PROMPT_GENERATE_MDT, file_obj, model_name, echo=echo
+    )
+    if echo:
         print("\n" + "=" * 50 + "\n")
 
-        # --- TASK 2: Factual Correctness ---
-        print("\n--- Task 2: Evaluating Factual Correctness ---")
-        formatted_prompt_factual = PROMPT_FACTUAL_CORRECTNESS.format(
-            transcript=transcript
+    # --- TASKS 2 & 3: Factual Correctness and Plausibility ---
+    # Both evaluations are requested in a single call so the transcript is sent once.
+    if echo:
+        print("\n--- Tasks 2 & 3: Evaluating Factual Correctness and Plausibility ---")
+    formatted_prompt_eval = PROMPT_COMBINED_EVAL.format(transcript=transcript)
+
+    async def evaluate():
+        return await get_model_response(
+            formatted_prompt_eval,
+            file_obj,
+            model_name,
+            generation_config={"response_mime_type": "application/json"},
+            validate=parse_evaluation,
+        )
+
+    if semantic_cache:
+        raw_evaluation = await SemanticCache(embed).get_or_set(
+            f"{model_name}:{EMBEDDING_MODEL}:combined_eval",
+            transcript,
+            evaluate,
+            validate=parse_evaluation,
         )
-        factual_feedback = get_model_response(formatted_prompt_factual, file_obj)
+    else:
+        raw_evaluation = await evaluate()
+    evaluation = parse_evaluation(raw_evaluation)
+
+    if echo:
         print("\n[FACTUAL CORRECTNESS FEEDBACK]\n")
-        print(factual_feedback)
+        print(evaluation["factual"])
         print("\n" + "=" * 50 + "\n")
 
-        # --- TASK 3: Plausibility ---
-        print("\n--- Task 3: Evaluating Plausibility ---")
-        formatted_prompt_plausibility = PROMPT_PLAUSIBILITY.format(
-            transcript=transcript
+        print("\n[PLAUSIBILITY FEEDBACK]\n")
+        print(evaluation["plausibility"])
+        print("\n" + "=" * 50 + "\n")
+
+    return {
+        "transcript": transcript,
+        "factual": evaluation["factual"],
+        "plausibility": evaluation["plausibility"],
+    }
+
+
+def count_pdf_pages(file_path):
+    """Returns the number of pages in a PDF file."""
+    return len(PdfReader(file_path).pages)
+
+
+async def batch_main(pdf_dir):
+    """Generates and evaluates MDT transcripts for every PDF in pdf_dir.
+
+    Files are uploaded and transcribed concurrently; files where either step
+    fails are logged and skipped. The evaluations are grouped into
+    micro-batches of several cases per request, which are also run concurrently.
+    Returns the results keyed by file name.
+    """
+    pdf_paths = sorted(glob.glob(os.path.join(pdf_dir, "*.pdf")))
+    if not pdf_paths:
+        raise FileNotFoundError(f"No PDF files found in {pdf_dir}")
+
+    model_name = await asyncio.to_thread(pick_available_model)
+
+    # --- TASK 1: Generate MDT Transcripts ---
+    print(f"\n--- Task 1: Generating MDT Transcripts for {len(pdf_paths)} files ---")
+    # Bounded so a large directory stays within the API's rate limits
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def generate(pdf_path):
+        async with semaphore:
+            file_obj = await upload_file(pdf_path)
+            transcript = await get_model_response(
+                PROMPT_GENERATE_MDT, file_obj, model_name
+            )
+        return file_obj, transcript
+
+    outcomes = await asyncio.gather(
+        *(generate(p) for p in pdf_paths), return_exceptions=True
+    )
+    # One failed file must not discard the others' transcripts
+    generated = []
+    for pdf_path, outcome in zip(pdf_paths, outcomes):
+        if isinstance(outcome, BaseException):
+            log.warning(
+                "Transcript generation failed for %s: %s",
+                os.path.basename(pdf_path),
+                outcome,
+            )
+        else:
+            generated.append((pdf_path, *outcome))
+    if not generated:
+        raise RuntimeError("No transcripts were generated.")
+    pdf_paths, file_objs, transcripts = (list(column) for column in zip(*generated))
+
+    # --- TASKS 2 & 3: Factual Correctness and Plausibility ---
+    print("\n--- Tasks 2 & 3: Evaluating Factual Correctness and Plausibility ---")
+    evaluations = {}
+
+    async def evaluate(indices):
+        names = ", ".join(os.path.basename(pdf_paths[i]) for i in indices)
+        # The case studies are attached as files in the same order as their index
+        cases = "\n".join(
+            f"CASE STUDY[{j}]: attached .pdf file number {j + 1}\n\nTRANSCRIPT[{j}]:\n{transcripts[i]}\n"
+            for j, i in enumerate(indices)
         )
-        # For plausibility, we don't need the PDF file.
-        model_name = pick_available_model()
-        model = genai.GenerativeModel(model_name=model_name)
-        plausibility_feedback = model.generate_content(
-            formatted_prompt_plausibility
-        ).text
+        # One failed group must not discard the others' evaluations
+        try:
+            raw_evaluation = await get_model_response(
+                PROMPT_COMBINED_EVAL_BATCH.format(cases=cases),
+                [file_objs[i] for i in indices],
+                model_name,
+                generation_config={"response_mime_type": "application/json"},
+                validate=parse_batch_evaluation,
+            )
+            entries = parse_batch_evaluation(raw_evaluation)
+        except (google_exceptions.GoogleAPIError, asyncio.TimeoutError, ValueError) as e:
+            log.warning("Evaluation failed for %s: %s", names, e)
+            return
+        # Map each entry's index within the micro-batch back to its file
+        for j, entry in entries.items():
+            if 0 <= j < len(indices):
+                evaluations[os.path.basename(pdf_paths[indices[j]])] = entry
+
+    # Each attached PDF is billed per page, the transcript at ~4 characters per token
+    page_counts = await asyncio.gather(
+        *(asyncio.to_thread(count_pdf_pages, p) for p in pdf_paths)
+    )
+    sizes = [
+        pages * TOKENS_PER_PDF_PAGE + len(transcript) // 4
+        for pages, transcript in zip(page_counts, transcripts)
+    ]
+    await asyncio.gather(
+        *(evaluate(indices) for indices in micro_batches(sizes, CONTEXT_TOKENS))
+    )
+
+    missing = [
+        os.path.basename(p) for p in pdf_paths if os.path.basename(p) not in evaluations
+    ]
+    if missing:
+        log.warning("No evaluation for: %s", ", ".join(missing))
+
+    results = {}
+    for pdf_path, transcript in zip(pdf_paths, transcripts):
+        name = os.path.basename(pdf_path)
+        evaluation = evaluations.get(name, {})
+        results[name] = {
+            "transcript": transcript,
+            "factual": evaluation.get("factual"),
+            "plausibility": evaluation.get("plausibility"),
+        }
+
+        print("\n" + "#" * 50)
+        print(f"# {name}")
+        print("#" * 50)
+
+        print("\n[GENERATED TRANSCRIPT]\n")
+        print(transcript)
+        print("\n" + "=" * 50 + "\n")
+
+        print("\n[FACTUAL CORRECTNESS FEEDBACK]\n")
+        print(results[name]["factual"])
+        print("\n" + "=" * 50 + "\n")
+
         print("\n[PLAUSIBILITY FEEDBACK]\n")
-        print(plausibility_feedback)
+        print(results[name]["plausibility"])
         print("\n" + "=" * 50 + "\n")
 
-    finally:
-        # Clean up the uploaded file
-        print("Cleaning up resources...")
-        genai.delete_file(file_obj.name)
-        print("Cleanup complete.")
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Generate and evaluate an MDT transcript with Gemini."
+    )
+    parser.add_argument(
+        "pdf_path",
+        help="path to the case study PDF, or a directory of PDFs to evaluate together",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="reuse evaluations of similar transcripts",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="log per-request progress (same as MDT_LOG=DEBUG)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        level="DEBUG" if args.verbose else os.getenv("MDT_LOG", "INFO"),
+        format="%(message)s",
+    )
+
+    try:
+        if os.path.isdir(args.pdf_path):
+            await batch_main(args.pdf_path)
+        else:
+            await run(args.pdf_path, semantic_cache=args.semantic_cache)
+    except (
+        google_exceptions.GoogleAPIError,
+        OSError,
+        RuntimeError,
+        ValueError,
+    ) as e:
+        log.error("Error: %s", e)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+from contextlib import closing
+import numpy as np
+
+log = logging.getLogger("mdt")
+
+# Shared on-disk cache location for all backends
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mdt-genai")
+
+
+def make_key(model, prompt, file_hash=""):
+    """Builds a cache key from the model, the prompt and the attached file's hash."""
+    return hashlib.sha256(f"{model}\0{prompt}\0{file_hash}".encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """A persistent SQLite cache for LLM responses.
+
+    Set LLM_CACHE_DISABLE=1 to bypass the cache entirely.
+    """
+
+    def __init__(self, db_path=None, ttl_days=7):
+        self.db_path = db_path or os.path.join(CACHE_DIR, "llm_cache.db")
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.disabled = os.getenv("LLM_CACHE_DISABLE") == "1"
+        if not self.disabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+
+    def get(self, key):
+        """Returns the cached response for key, or None if missing or expired."""
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            row = conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def delete(self, key):
+        """Removes the response stored under key."""
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def set(self, key, value):
+        """Stores a response under key."""
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+
+    async def get_or_set(self, key, fetch_fn, validate=None):
+        """Returns the cached response for key, awaiting fetch_fn() on a miss.
+
+        If given, validate(value) must raise ValueError for an unusable response.
+        Such responses are never stored, and are evicted if found in the cache.
+        """
+        if self.disabled:
+            return await fetch_fn()
+
+        value = self.get(key)
+        if value is not None:
+            try:
+                if validate is not None:
+                    validate(value)
+                log.info("Using cached response.")
+                return value
+            except ValueError:
+                log.warning("Discarding invalid cached response.")
+                self.delete(key)
+
+        value = await fetch_fn()
+        if validate is not None:
+            validate(value)
+        self.set(key, value)
+        return value
+
+
+class SemanticCache:
+    """A persistent cache that matches prompts by embedding similarity.
+
+    Near-duplicate inputs (e.g. transcripts of the same case template) reuse a
+    stored response when their cosine similarity exceeds the threshold. Entries
+    are scoped by namespace so responses from different models or tasks never
+    mix. Set LLM_CACHE_DISABLE=1 to bypass the cache entirely.
+    """
+
+    def __init__(self, embed_fn, db_path=None, threshold=0.93, ttl_days=7):
+        self.embed_fn = embed_fn
+        self.db_path = db_path or os.path.join(CACHE_DIR, "semcache.db")
+        self.threshold = threshold
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.disabled = os.getenv("LLM_CACHE_DISABLE") == "1"
+        if not self.disabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "namespace TEXT NOT NULL, embedding BLOB NOT NULL, "
+                    "value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+
+    def get(self, namespace, embedding, validate=None):
+        """Returns the most similar cached response above the threshold, or None.
+
+        If the match fails validate(value), it is evicted and None is returned.
+        """
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            rows = conn.execute(
+                "SELECT embedding, value, rowid FROM responses WHERE namespace = ? AND created_at >= ?",
+                (namespace, time.time() - self.ttl),
+            ).fetchall()
+        if not rows:
+            return None
+
+        # Stored embeddings are unit-normalised, so the dot product is the cosine similarity
+        matrix = np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+        similarities = matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] <= self.threshold:
+            return None
+        if validate is not None:
+            try:
+                validate(rows[best][1])
+            except ValueError:
+                log.warning("Discarding invalid semantically cached response.")
+                with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                    conn.execute("DELETE FROM responses WHERE rowid = ?", (rows[best][2],))
+                return None
+        log.info(
+            "Using semantically cached response (similarity %.3f).", similarities[best]
+        )
+        return rows[best][1]
+
+    def set(self, namespace, embedding, value):
+        """Stores a response under the given embedding."""
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute(
+                "INSERT INTO responses (namespace, embedding, value, created_at) VALUES (?, ?, ?, ?)",
+                (namespace, embedding.tobytes(), value, time.time()),
+            )
+
+    async def get_or_set(self, namespace, text, fetch_fn, validate=None):
+        """Returns a cached response for text similar to this one, awaiting fetch_fn() on a miss.
+
+        validate behaves as in LLMCache.get_or_set.
+        """
+        if self.disabled:
+            return await fetch_fn()
+
+        embedding = np.asarray(await self.embed_fn(text[:4000]), dtype=np.float32)
+        embedding /= np.linalg.norm(embedding)
+
+        value = self.get(namespace, embedding, validate)
+        if value is not None:
+            return value
+
+        value = await fetch_fn()
+        if validate is not None:
+            validate(value)
+        self.set(namespace, embedding, value)
+        return value
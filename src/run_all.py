@@ -0,0 +1,74 @@
+import os
+import sys
+import asyncio
+import argparse
+import logging
+import chatgpt
+import gemini
+
+# Each backend's pipeline, run concurrently on the same case study
+BACKENDS = {
+    "ChatGPT": chatgpt.run,
+    "Gemini": gemini.run,
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Generate and evaluate an MDT transcript with every backend at once."
+    )
+    parser.add_argument("pdf_path", help="path to the case study PDF")
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="reuse evaluations of similar transcripts",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="log per-request progress (same as MDT_LOG=DEBUG)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        level="DEBUG" if args.verbose else os.getenv("MDT_LOG", "INFO"),
+        format="%(message)s",
+    )
+
+    # Collect exceptions so one failing backend doesn't discard the other's results
+    results = await asyncio.gather(
+        *(
+            run(args.pdf_path, echo=False, semantic_cache=args.semantic_cache)
+            for run in BACKENDS.values()
+        ),
+        return_exceptions=True,
+    )
+
+    failed = False
+    for name, result in zip(BACKENDS, results):
+        print("\n" + "#" * 50)
+        print(f"# {name}")
+        print("#" * 50)
+
+        if isinstance(result, Exception):
+            print(f"\nError: {result}")
+            failed = True
+            continue
+
+        print("\n[GENERATED TRANSCRIPT]\n")
+        print(result["transcript"])
+        print("\n" + "=" * 50 + "\n")
+
+        print("\n[FACTUAL CORRECTNESS FEEDBACK]\n")
+        print(result["factual"])
+        print("\n" + "=" * 50 + "\n")
+
+        print("\n[PLAUSIBILITY FEEDBACK]\n")
+        print(result["plausibility"])
+        print("\n" + "=" * 50 + "\n")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())